@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+'''
+bench_reader -- compare the serial reads and CPU per poll cycle of the old
+readline() based readLine() and the buffered ModemReader.
+
+The responses of modem-input.json are replayed through a fake serial port that
+delivers at most 64 bytes per read(), like the USB endpoint of the modem.
+
+    ./bench_reader.py [-n CYCLES] [-c CHUNK] [modem-input.json]
+'''
+
+import sys, time, json
+from os import path
+import argparse
+
+import quectel
+
+
+class FakeSerial(object):
+    """ replays the AT responses of a json input file, read() returns at most chunk bytes """
+
+    def __init__(self, data, chunk=64):
+        self.data = data
+        self.chunk = chunk
+        self.out = b''
+        self.pos = 0
+        self.reads = 0
+
+    def write(self, cmd):
+        cmd = cmd.decode().strip()
+        body = ''
+        for command in quectel.COMMANDS.keys():
+            if quectel.COMMANDS[command]['cmd'] == cmd:
+                body = ''.join(line + '\r\n' for line in self.data[command])
+                break
+        self.out = self.out[self.pos:] + ('\r\n' + body + '\r\nOK\r\n').encode()
+        self.pos = 0
+
+    @property
+    def in_waiting(self):
+        return min(self.chunk, len(self.out) - self.pos)
+
+    def read(self, size=1):
+        self.reads = self.reads + 1
+        r = self.out[self.pos:self.pos + size]
+        self.pos = self.pos + len(r)
+        return r
+
+    def readline(self):
+        """ like pyserial, readline() is a loop of read(1) """
+        line = b''
+        while True:
+            c = self.read(1)
+            if not c:
+                return line
+            line = line + c
+            if c == b'\n':
+                return line
+
+    def reset_input_buffer(self):
+        pass
+
+
+def readLine(signal, name):
+    """ the readline() based reader ModemReader replaced """
+    line = ""
+    lines = []
+    while line != 'OK' and line != 'ERROR':
+        r = signal.readline().rstrip()
+        quectel.log.debug(f'read "{r}" from {name}')
+        line = r.decode("utf-8")
+        if line == '' or line == 'OK':
+            continue
+        lines.append(line)
+
+    return(lines)
+
+
+def cycleOld(modem):
+    data = {}
+    for command in quectel.COMMANDS.keys():
+        modem.write((quectel.COMMANDS[command]['cmd'] + "\r\n").encode())
+        data[command] = readLine(modem, 'fake')
+    return(data)
+
+
+def cycleNew(modem):
+    reader = quectel.ModemReader(modem, 'fake')
+    data = {}
+    for command in quectel.COMMANDS.keys():
+        modem.write((quectel.COMMANDS[command]['cmd'] + "\r\n").encode())
+        data[command] = reader.readResponse()
+    return(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--cycles', type=int, dest="cycles", default=300,
+                        help="poll cycles per reader [default: %(default)s]")
+    parser.add_argument('-c', '--chunk', type=int, dest="chunk", default=64,
+                        help="max bytes returned per read() [default: %(default)s]")
+    parser.add_argument('input', nargs='?', default=path.join(path.dirname(path.abspath(__file__)), 'modem-input.json'),
+                        help="json input file [default: %(default)s]")
+    args = parser.parse_args()
+
+    with open(args.input) as fp:
+        data = json.load(fp)
+
+    for name, cycle in (('readLine', cycleOld), ('ModemReader', cycleNew)):
+        modem = FakeSerial(data, args.chunk)
+        result = cycle(modem)
+        if result != data:
+            print(f'{name} parsed responses differ from {args.input}')
+            return(1)
+        reads = modem.reads
+
+        start = time.process_time()
+        i = 0
+        while i < args.cycles:
+            cycle(FakeSerial(data, args.chunk))
+            i = i + 1
+        cpu = (time.process_time() - start) / args.cycles
+
+        print(f'{name:12} {reads:5} read() calls, {cpu * 1000:.3f} ms CPU per cycle')
+
+    return(0)
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -44,16 +44,28 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 '''
 
 import sys, os, time
+import math
 from os import path
 import argparse
 import serial, json
 import re
+import multiprocessing
+import select
+import socket
+import struct
+from bisect import bisect_right
 import prometheus_client
 import pwd
+import tempfile
 import grp
+import threading
+from array import array
+from urllib.parse import parse_qs
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
 
 import logging
-from prometheus_client import Histogram, CollectorRegistry, start_http_server, Gauge, Info, generate_latest
+from prometheus_client import Histogram, CollectorRegistry, Counter, Gauge, Info, generate_latest, make_wsgi_app
 
 FREQ_URL = "https://rahix.github.io/frequency-bands/data/fb.csv"
 
@@ -70,6 +82,71 @@ MODEMPORT = "/dev/ttyUSB2"
 MODEMBAUDRATE = 115200
 FREQDATA = {}
 POLL_INTERVAL = 20
+HISTORY_HOURS = 24
+STATE_FILE = "/var/lib/quectel_exporter/state.json"
+STATE_VERSION = 1
+WORKER_TIMEOUT = 60
+
+# 3GPP TS 36.101 table 5.7.3-1: band: (F_DL_low, N_Offs-DL, N_DL_high, F_UL_low, N_Offs-UL, N_UL_high), frequencies in MHz
+EUTRA_BANDS = {1: (2110, 0, 599, 1920, 18000, 18599),
+               2: (1930, 600, 1199, 1850, 18600, 19199),
+               3: (1805, 1200, 1949, 1710, 19200, 19949),
+               4: (2110, 1950, 2399, 1710, 19950, 20399),
+               5: (869, 2400, 2649, 824, 20400, 20649),
+               6: (875, 2650, 2749, 830, 20650, 20749),
+               7: (2620, 2750, 3449, 2500, 20750, 21449),
+               8: (925, 3450, 3799, 880, 21450, 21799),
+               9: (1844.9, 3800, 4149, 1749.9, 21800, 22149),
+               10: (2110, 4150, 4749, 1710, 22150, 22749),
+               11: (1475.9, 4750, 4949, 1427.9, 22750, 22949),
+               12: (729, 5010, 5179, 699, 23010, 23179),
+               13: (746, 5180, 5279, 777, 23180, 23279),
+               14: (758, 5280, 5379, 788, 23280, 23379),
+               17: (734, 5730, 5849, 704, 23730, 23849),
+               18: (860, 5850, 5999, 815, 23850, 23999),
+               19: (875, 6000, 6149, 830, 24000, 24149),
+               20: (791, 6150, 6449, 832, 24150, 24449),
+               21: (1495.9, 6450, 6599, 1447.9, 24450, 24599),
+               22: (3510, 6600, 7399, 3410, 24600, 25399),
+               23: (2180, 7500, 7699, 2000, 25500, 25699),
+               24: (1525, 7700, 8039, 1626.5, 25700, 26039),
+               25: (1930, 8040, 8689, 1850, 26040, 26689),
+               26: (859, 8690, 9039, 814, 26690, 27039),
+               27: (852, 9040, 9209, 807, 27040, 27209),
+               28: (758, 9210, 9659, 703, 27210, 27659),
+               29: (717, 9660, 9769, None, None, None),
+               30: (2350, 9770, 9869, 2305, 27660, 27759),
+               31: (462.5, 9870, 9919, 452.5, 27760, 27809),
+               32: (1452, 9920, 10359, None, None, None),
+               33: (1900, 36000, 36199, 1900, 36000, 36199),
+               34: (2010, 36200, 36349, 2010, 36200, 36349),
+               35: (1850, 36350, 36949, 1850, 36350, 36949),
+               36: (1930, 36950, 37549, 1930, 36950, 37549),
+               37: (1910, 37550, 37749, 1910, 37550, 37749),
+               38: (2570, 37750, 38249, 2570, 37750, 38249),
+               39: (1880, 38250, 38649, 1880, 38250, 38649),
+               40: (2300, 38650, 39649, 2300, 38650, 39649),
+               41: (2496, 39650, 41589, 2496, 39650, 41589),
+               42: (3400, 41590, 43589, 3400, 41590, 43589),
+               43: (3600, 43590, 45589, 3600, 43590, 45589),
+               44: (703, 45590, 46589, 703, 45590, 46589),
+               45: (1447, 46590, 46789, 1447, 46590, 46789),
+               46: (5150, 46790, 54539, None, None, None),
+               47: (5855, 54540, 55239, 5855, 54540, 55239),
+               48: (3550, 55240, 56739, 3550, 55240, 56739),
+               65: (2110, 65536, 66435, 1920, 131072, 131971),
+               66: (2110, 66436, 67335, 1710, 131972, 132671),
+               67: (738, 67336, 67535, None, None, None),
+               68: (753, 67536, 67835, 698, 132672, 132971),
+               69: (2570, 67836, 68335, None, None, None),
+               70: (1995, 68336, 68585, 1695, 132972, 133121),
+               71: (617, 68586, 68935, 663, 133122, 133471),
+               }
+
+# EUTRA_BANDS sorted on the first downlink EARFCN of each band, searched with bisect
+EARFCN_INDEX = sorted((offs_dl, high_dl, band, f_dl, f_ul, offs_ul, high_ul)
+                      for band, (f_dl, offs_dl, high_dl, f_ul, offs_ul, high_ul) in EUTRA_BANDS.items())
+EARFCN_STARTS = [entry[0] for entry in EARFCN_INDEX]
 
 ACCESS_TECHNOLOGY = {"0": "GSM",
                      "2": "UTRAN",
@@ -134,6 +211,8 @@ NUM_DATA = ['freq_operating_band',
             'freq_uplink_upper',
             'freq_downlink_lower',
             'freq_downlink_upper',
+            'carrier_dl_frequency',
+            'carrier_ul_frequency',
             'ul_bandwidth',
             'dl_bandwidth',
             'rsrp',
@@ -163,6 +242,41 @@ def COPS(text, data, string_name):
         log.debug('+COPS: empty?')
 
     
+def carrierFrequency(earfcn):
+    """
+    return (band, downlink MHz, uplink MHz) of the carrier center frequency of a downlink EARFCN,
+    the uplink is None for supplemental downlink bands and downlink channels without a paired
+    uplink channel. Returns None for an unknown EARFCN.
+    """
+    i = bisect_right(EARFCN_STARTS, earfcn) - 1
+    if i < 0:
+        return None
+    offs_dl, high_dl, band, f_dl, f_ul, offs_ul, high_ul = EARFCN_INDEX[i]
+    if earfcn > high_dl:
+        return None
+
+    dl = round(f_dl + 0.1 * (earfcn - offs_dl), 1)
+
+    # the default uplink channel is at the same offset in the band (N_UL - N_Offs-UL == N_DL - N_Offs-DL),
+    # bands with more downlink than uplink spectrum (66, 70) have no paired uplink for the top channels
+    ul = None
+    if f_ul is not None and offs_ul + (earfcn - offs_dl) <= high_ul:
+        ul = round(f_ul + 0.1 * (earfcn - offs_dl), 1)
+    return (band, dl, ul)
+
+
+def setCarrierFrequency(earfcn, data):
+    carrier = carrierFrequency(earfcn)
+    if carrier is None:
+        log.debug(f'no E-UTRA band for earfcn {earfcn}')
+        return
+
+    data['carrier_dl_frequency'] = carrier[1]
+    if carrier[2] is not None:
+        data['carrier_ul_frequency'] = carrier[2]
+    log.debug(f'earfcn {earfcn} -> band {carrier[0]} dl {carrier[1]} MHz ul {carrier[2]} MHz')
+
+
 def QENG(text, data, string_name):
     """
     '+QENG: "servingcell","NOCONN","LTE","FDD",222,88,586A512,18,125,1,4,4,8119,-107,-12,-74,12,-'
@@ -222,6 +336,9 @@ def QENG(text, data, string_name):
         log.debug(f'transform {strings[i]} {data_list[i]} -> {data[strings[i]]}')
         i = i + 1
 
+    if data.get('connection_type') == 'LTE' and isinstance(data.get('earfcn'), int):
+        setCarrierFrequency(data['earfcn'], data)
+
     return (data)
 
 
@@ -292,6 +409,9 @@ def QNWINFO(text, data, string_name):
 
         log.debug(f'transform {strings[i]} {data_list[i]} -> {data[strings[i]]}')
         i = i + 1
+
+    if 'LTE' in data_list[0] and 'carrier_dl_frequency' not in data and isinstance(data.get('channel'), int):
+        setCarrierFrequency(data['channel'], data)
         
 
 def QSPN(text, data, string_name):
@@ -482,23 +602,27 @@ COMMANDS = {
 
     },
     'firmware': {
+        'static': True,
         'cmd': 'AT+GMR',
         'description': 'Firmware Revision Identification',
         'run': VAR
 
     },
     'model': {
+        'static': True,
         'cmd': 'AT+GMM',
         'description': 'Model Identification',
         'run': VAR
     },
     'manufacturer': {
+        'static': True,
         'cmd': 'AT+GMI',
         'description': 'Manufacturer Identification',
         'run': VAR
 
     },
     'imei_sn': {
+        'static': True,
         'cmd': 'AT+GSN=0',
         'description': 'International Mobile Equipment Identity (IMEI)',
         'run': VAR
@@ -520,6 +644,7 @@ COMMANDS = {
         'run': CGACT
     },
     'ATI': {
+        'static': True,
         'cmd': 'ATI',
         'description': 'Modem information'
     },
@@ -537,6 +662,355 @@ COMMANDS = {
 }
 
 
+class SnapshotSection(object):
+    """ base class for a group of stats fields, the fields are the __slots__ of the subclass """
+    __slots__ = ()
+
+    def __init__(self, stats=None):
+        for field in self.__slots__:
+            setattr(self, field, stats.get(field) if stats else None)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.__slots__]
+
+    def __repr__(self):
+        return type(self).__name__ + '(' + ', '.join(f'{f}={v!r}' for f, v in self.items() if v is not None) + ')'
+
+    def diff(self, other):
+        """ return {field: (old, new)} for the fields that differ from other """
+        changes = {}
+        for field in self.__slots__:
+            new = getattr(self, field)
+            old = getattr(other, field) if other is not None else None
+            if new != old:
+                changes[field] = (old, new)
+        return changes
+
+
+class ServingCell(SnapshotSection):
+    __slots__ = ('state', 'state_txt', 'connection_type', 'is_tdd', 'mcc', 'mnc', 'cellID', 'pcid', 'earfcn',
+                 'freq_band_ind', 'ul_bandwidth', 'dl_bandwidth', 'tac', 'rsrp', 'rsrq', 'rssi', 'sinr',
+                 'freq_operating_band', 'freq_duplex_mode', 'freq_note', 'freq_uplink_lower', 'freq_uplink_upper',
+                 'freq_downlink_lower', 'freq_downlink_upper', 'carrier_dl_frequency', 'carrier_ul_frequency')
+
+
+class Registration(SnapshotSection):
+    __slots__ = ('pin', 'connection_status', 'lac', 'operator', 'access_technology', 'operator_num', 'band',
+                 'channel', 'service_provider_name', 'full_network_name', 'short_network_name',
+                 'registered_public_land_mobile_network', 'alphabet', 'network_time')
+
+
+class Identity(SnapshotSection):
+    __slots__ = ('qccid', 'imsi', 'firmware', 'model', 'manufacturer', 'imei_sn', 'imei')
+
+
+class Indicators(SnapshotSection):
+    __slots__ = ('battchg', 'signal', 'service', 'call', 'roam', 'smsfull', 'gprs_coverage', 'callsetup')
+
+
+class Counters(SnapshotSection):
+    __slots__ = ('bytes_sent', 'bytes_recv')
+
+
+class PdpContext(SnapshotSection):
+    __slots__ = ('PDP_type', 'APN', 'PDP_addr', 'data_comp', 'head_comp', 'IPv4_addr_alloc', 'request_type', 'active')
+
+
+class ModemSnapshot(object):
+    """
+    Typed view of one poll of the modem, built from the stats dict of the transform functions.
+    """
+    __slots__ = ('timestamp', 'serving_cell', 'registration', 'identity', 'indicators', 'counters', 'pdp')
+
+    SECTIONS = ('serving_cell', 'registration', 'identity', 'indicators', 'counters')
+
+    def __init__(self, stats, timestamp=None):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.serving_cell = ServingCell(stats)
+        self.registration = Registration(stats)
+        self.identity = Identity(stats)
+        self.indicators = Indicators(stats)
+        self.counters = Counters(stats)
+        self.pdp = {}
+        for cid, context in stats.get('pdp', {}).items():
+            self.pdp[cid] = PdpContext(context)
+
+    def diff(self, previous):
+        """
+        return (changes, pdp_changes): {field: (old, new)} of the sections and
+        {cid: (old PdpContext, new PdpContext)} of the pdp contexts that differ from previous.
+        """
+        changes = {}
+        for section in self.SECTIONS:
+            changes.update(getattr(self, section).diff(getattr(previous, section) if previous else None))
+
+        pdp_changes = {}
+        old_pdp = previous.pdp if previous else {}
+        for cid in set(self.pdp) | set(old_pdp):
+            if self.pdp.get(cid) != old_pdp.get(cid):
+                pdp_changes[cid] = (old_pdp.get(cid), self.pdp.get(cid))
+
+        return (changes, pdp_changes)
+
+
+class ChangeEvent(object):
+    __slots__ = ('kind', 'subject', 'port', 'timestamp', 'old', 'new')
+
+    def __init__(self, kind, subject, port, timestamp, old, new):
+        self.kind = kind
+        self.subject = subject
+        self.port = port
+        self.timestamp = timestamp
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return f'ChangeEvent({self.kind} {self.subject} on {self.port}: {self.old} -> {self.new})'
+
+
+class ChangeEvents(object):
+    """
+    Change event stream, subscribers are called with a ChangeEvent for:
+
+        cell_change   the serving cell (cellID, pcid or earfcn) changed
+        state_change  the UE state or the network registration status changed
+        pdp_down      an active pdp context became inactive or disappeared
+        pdp_up        a pdp context became active
+    """
+    KINDS = ('cell_change', 'state_change', 'pdp_down', 'pdp_up')
+
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback, kinds=None):
+        for kind in kinds or ():
+            if kind not in self.KINDS:
+                raise ValueError(f'unknown change event kind {kind}, expected one of {self.KINDS}')
+        self.subscribers.append((callback, kinds))
+
+    def publish(self, event):
+        for callback, kinds in self.subscribers:
+            if kinds and event.kind not in kinds:
+                continue
+            try:
+                callback(event)
+            except Exception as e:
+                log.critical(f'change event subscriber {callback} failed on {event}: {e}')
+
+    def emit(self, port, snapshot, previous, changes, pdp_changes):
+        """ publish the events for the changes between previous and snapshot """
+        if previous is None:
+            return
+
+        cell = ('cellID', 'pcid', 'earfcn')
+        if any(field in changes for field in cell):
+            self.publish(ChangeEvent('cell_change', '/'.join(cell), port, snapshot.timestamp,
+                                     tuple(getattr(previous.serving_cell, f) for f in cell),
+                                     tuple(getattr(snapshot.serving_cell, f) for f in cell)))
+
+        for field in ('state', 'connection_status'):
+            if field in changes:
+                self.publish(ChangeEvent('state_change', field, port, snapshot.timestamp, *changes[field]))
+
+        for cid, (old, new) in sorted(pdp_changes.items()):
+            was_active = old is not None and old.active == '1'
+            is_active = new is not None and new.active == '1'
+            if was_active and not is_active:
+                self.publish(ChangeEvent('pdp_down', cid, port, snapshot.timestamp, old, new))
+            elif is_active and not was_active:
+                self.publish(ChangeEvent('pdp_up', cid, port, snapshot.timestamp, old, new))
+
+
+class RingBuffer(object):
+    """
+    Fixed size ring buffer of (timestamp, value) samples.
+
+    Samples are kept in two preallocated array('d') buffers, so every series
+    costs 16 bytes per sample (8 byte timestamp + 8 byte value) no matter how
+    long the exporter runs. When the buffer is full the oldest sample is
+    overwritten.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+
+    def append(self, timestamp, value):
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size = self.size + 1
+
+    def samples(self, start, end):
+        first = (self.head - self.size) % self.capacity
+        i = 0
+        while i < self.size:
+            idx = (first + i) % self.capacity
+            timestamp = self.timestamps[idx]
+            if start <= timestamp <= end:
+                yield (timestamp, self.values[idx])
+            i = i + 1
+
+    def nbytes(self):
+        return (self.timestamps.itemsize + self.values.itemsize) * self.capacity
+
+
+class MetricHistory(object):
+    """
+    In-process history of the NUM_DATA gauges, one RingBuffer per metric and port.
+
+    The capacity of each series is hours * 3600 / interval samples, e.g. 24 hours
+    at the default 20 second poll interval is 4320 samples or ~68 KiB per series,
+    ~1.6 MiB for all NUM_DATA gauges of one port.
+    """
+
+    def __init__(self, hours, interval):
+        self.hours = hours
+        self.capacity = max(1, int(hours * 3600 / max(interval, 1)))
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def record(self, port, stats, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.lock:
+            for i in NUM_DATA:
+                if i not in stats:
+                    continue
+                try:
+                    value = float(stats[i])
+                except (TypeError, ValueError):
+                    log.debug(f'not recording {i} = {stats[i]} in history')
+                    continue
+
+                key = (i, port)
+                if key not in self.series:
+                    self.series[key] = RingBuffer(self.capacity)
+                self.series[key].append(timestamp, value)
+
+    def index(self):
+        with self.lock:
+            return [{'metric': metric, 'port': port, 'samples': buf.size,
+                     'capacity': buf.capacity, 'bytes': buf.nbytes()}
+                    for (metric, port), buf in sorted(self.series.items())]
+
+    def ports(self):
+        with self.lock:
+            return sorted(set(port for (metric, port) in self.series.keys()))
+
+    def query(self, metric, port, start, end, step):
+        """ return the samples between start and end downsampled into min/max/avg buckets of step seconds """
+        buckets = {}
+        with self.lock:
+            if (metric, port) not in self.series:
+                return []
+            for timestamp, value in self.series[(metric, port)].samples(start, end):
+                b = int((timestamp - start) // step)
+                if b not in buckets:
+                    buckets[b] = [value, value, value, 1]
+                else:
+                    bucket = buckets[b]
+                    bucket[0] = min(bucket[0], value)
+                    bucket[1] = max(bucket[1], value)
+                    bucket[2] = bucket[2] + value
+                    bucket[3] = bucket[3] + 1
+
+        return [{'time': start + b * step,
+                 'min': bucket[0],
+                 'max': bucket[1],
+                 'avg': bucket[2] / bucket[3],
+                 'count': bucket[3]} for b, bucket in sorted(buckets.items())]
+
+
+def historyApp(history):
+    """
+    WSGI app serving /history?metric=<name>[&port=<port>][&start=<epoch>][&end=<epoch>][&step=<seconds>][&format=json|csv]
+
+    Without a metric the list of recorded series and their memory use is returned.
+    """
+
+    def app(environ, start_response):
+        params = parse_qs(environ.get('QUERY_STRING', ''))
+
+        def param(name, default=None):
+            return params[name][0] if name in params else default
+
+        def reply(status, body, content_type='application/json'):
+            body = body.encode()
+            start_response(status, [('Content-Type', content_type), ('Content-Length', str(len(body)))])
+            return [body]
+
+        metric = param('metric')
+        if metric is None:
+            return reply('200 OK', json.dumps(history.index(), indent=4))
+
+        if metric not in NUM_DATA:
+            return reply('400 Bad Request', f'unknown metric {metric}\n', 'text/plain')
+
+        ports = history.ports()
+        port = param('port', ports[0] if ports else '')
+
+        try:
+            end = float(param('end', time.time()))
+            start = float(param('start', end - 3600))
+            step = float(param('step', 60))
+        except ValueError as e:
+            return reply('400 Bad Request', f'{e}\n', 'text/plain')
+
+        if not all(math.isfinite(v) for v in (start, end, step)):
+            return reply('400 Bad Request', 'start, end and step must be finite numbers\n', 'text/plain')
+
+        if step <= 0 or start > end:
+            return reply('400 Bad Request', 'step must be > 0 and start <= end\n', 'text/plain')
+
+        buckets = history.query(metric, port, start, end, step)
+
+        if param('format', 'json') == 'csv':
+            lines = ['time,min,max,avg,count']
+            for b in buckets:
+                lines.append(f"{b['time']},{b['min']},{b['max']},{b['avg']},{b['count']}")
+            return reply('200 OK', "\n".join(lines) + "\n", 'text/csv')
+
+        return reply('200 OK', json.dumps({'metric': metric, 'port': port, 'start': start,
+                                           'end': end, 'step': step, 'buckets': buckets}, indent=4))
+
+    return app
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _SilentHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def startExporterServer(port, registry, history=None):
+    """ start_http_server() with an additional /history endpoint """
+    metrics_app = make_wsgi_app(registry)
+    history_app = historyApp(history) if history else None
+
+    def app(environ, start_response):
+        if history_app and environ.get('PATH_INFO') == '/history':
+            return history_app(environ, start_response)
+        return metrics_app(environ, start_response)
+
+    httpd = make_server('', port, app, _ThreadingWSGIServer, handler_class=_SilentHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    return httpd
+
+
 def main():
     '''main function.'''
     global FREQDATA
@@ -582,6 +1056,10 @@ USAGE''' % (program_shortdesc, str(__date__))
     parser.add_argument('-b', '--baudrate', type=int, dest="baudrate", default=MODEMBAUDRATE,
                         help="set the baudrate of the serial port of the modem [default: %(default)s]")
     
+    parser.add_argument('-B', '--backend', type=str, dest="backend", default="at", choices=BACKENDS.keys(),
+                        help="poll the modem with AT commands on a serial port, QMI on a /dev/cdc-wdm device " +
+                        "or a simulated QMI device [default: %(default)s]")
+
     parser.add_argument('-j', '--json', action="store_true", dest="json", default=False,
                         help="Read the device as a json input file: %(default)s], ")
     
@@ -591,6 +1069,15 @@ USAGE''' % (program_shortdesc, str(__date__))
     parser.add_argument('-w', '--daemonize', action="store_true", dest="daemonize", default=False,
                         help="daemonize and listen on PORT to incoming requests. : %(default)s]")
 
+    parser.add_argument('-W', '--worker', action="store_true", dest="worker", default=False,
+                        help="poll the modem in a supervised child process in daemon mode. : %(default)s]")
+
+    parser.add_argument('-H', '--history', type=float, dest="history", default=HISTORY_HOURS,
+                        help="hours of metric history kept in memory and served on /history, 0 disables [default: %(default)s]")
+
+    parser.add_argument('-S', '--state-file', type=str, dest="state_file", default=STATE_FILE,
+                        help="file the last poll is saved to in daemon mode and restored from at startup, '' disables [default: %(default)s]")
+
     parser.add_argument('-u,', '--username', type=str, dest="username",
                         default="nobody",
                         help="Run the exporter as a specific user drop. " + 
@@ -611,88 +1098,406 @@ USAGE''' % (program_shortdesc, str(__date__))
     
     log.info (f'started with args {args}')
     
+    if (args.daemonize and args.state_file):
+        prepareStateDirectory(args.state_file, uid_name=args.username, gid_name=args.group)
+
     if (args.username and args.group):
         drop_privileges(uid_name=args.username,gid_name=args.group)
 
     """ init prometheus_client """
     registry = prometheus_client.CollectorRegistry()
+    metrics = ModemMetrics(registry)
 
-    lte_info = Info('lte_modem', 'LTE modem and connection info', labelnames=['port'], registry=registry)
-    
-    lte_pdp_info = Info('lte_modem_pdp', 'LTE modem pdp info', labelnames=['cid', 'port'], registry=registry)
-    
-    stats_list = {}
-    for i in NUM_DATA:
-        stats_list[i] = Gauge('lte_modem_' + i, i, labelnames=['port'], registry=registry)
+    history = None
+    if args.daemonize and args.history > 0:
+        history = MetricHistory(args.history, args.interval)
+
+    events = ChangeEvents()
+    events.subscribe(lambda event: log.info(f'{event}'))
+    previous = None
+
+    state = {}
+    if args.daemonize and args.state_file:
+        state = loadState(args.state_file, args.device.name)
+
+    backend = BACKENDS[args.backend](args)
+
+    if state:
+        FREQDATA = state.get('freqdata', FREQDATA)
+        if state.get('backend', 'at') == args.backend:
+            backend.identity = state.get('identity', {})
+        previous, changes, pdp_changes = metrics.update(args.device.name, state['stats'], None, stale=True)
+        log.info(f"restored metrics of {time.ctime(state['timestamp'])} from {args.state_file}")
+
+    worker = None
+    if args.daemonize and args.worker:
+        worker = CollectorWorker(backend, args, registry)
+        worker.start()
 
     if args.daemonize:
-        start_http_server(args.exporter_port, registry=registry)
+        startExporterServer(args.exporter_port, registry, history)
 
     while True:
 
-        if args.frequency and not FREQDATA:
-            FREQDATA = getFreqdata()
+        if worker:
+            message = worker.receive()
+            if message is None:
+                continue
+            stats = message['stats']
+            backend.identity = message['identity']
+            FREQDATA = message['freqdata']
+        else:
+            if args.frequency and not FREQDATA:
+                FREQDATA = getFreqdata()
 
-        data = getData(args)
+            stats = backend.poll()
 
-        if not data and args.daemonize:
-            time.sleep(args.interval)
+        if not stats and args.daemonize:
+            if not worker:
+                time.sleep(args.interval)
             continue
-        if not data:
+        if not stats:
+            backend.close()
             return(None)
         
-        if (args.debug):
-            log.debug(json.dumps(data, indent=4)) 
-        
-        stats = {}
-        
-        for cmd in COMMANDS.keys():
-            if 'run' in COMMANDS[cmd]:
-                log.debug(f'{cmd} has transform function')
-                COMMANDS[cmd]['run'](data[cmd], stats, cmd)
-        
-        info = {}
-        for i in INFO_DATA:
-            if i in stats:
-                info[i] = str(stats[i])
-    
-        lte_info.labels(args.device.name).info(info)
-    
-        for i in NUM_DATA:
-            if i in stats:
-                stats_list[i].labels(args.device.name).set(stats[i])
-        
-        for i in stats['pdp'].keys():
-            stats['pdp'][i]['active'] = stats['pdp_active'][i]['active']
-            lte_pdp_info.labels(i, args.device.name).info(stats['pdp'][i])
+        applyCounterOffsets(stats, state.setdefault('counters', {}))
+
+        snapshot, changes, pdp_changes = metrics.update(args.device.name, stats, previous)
+        events.emit(args.device.name, snapshot, previous, changes, pdp_changes)
+        previous = snapshot
+
+        if history:
+            history.record(args.device.name, stats)
+
+        if args.daemonize and args.state_file:
+            state['port'] = args.device.name
+            state['timestamp'] = snapshot.timestamp
+            state['stats'] = stats
+            state['backend'] = args.backend
+            state['identity'] = backend.identity
+            state['freqdata'] = FREQDATA
+            saveState(args.state_file, state)
         
         if (args.debug):
             log.debug (json.dumps(stats, indent=4))
 
-        log.info(f"Fetched data from lte modem on port: {args.device.name}: {stats['model']} rssi: {stats['rssi']} ")
+        log.info(f"Fetched data from lte modem on port: {args.device.name}: {stats.get('model')} rssi: {stats.get('rssi')} ")
 
         if not args.daemonize:
             print(generate_latest(registry=registry).decode())
+            backend.close()
             return(None)
         
-        time.sleep(args.interval)
+        if not worker:
+            time.sleep(args.interval)
         
 
-def readLine(signal, args):
-    line = ""
-    lines = []
-    while line != 'OK' and line != 'ERROR':
-        r = signal.readline().rstrip()
-        log.debug(f'read "{r}" from {args.device.name}')
-        line = r.decode("utf-8")
-        if line == '' or line == 'OK':
+def collectorMain(options, identity, freqdata, level, conn):
+    """
+    main loop of the collector process, sends every poll to the parent until the pipe is closed.
+    The process comes from a forkserver, so the backend is rebuilt from the picklable options.
+    """
+    global FREQDATA
+
+    log.setLevel(level)
+    FREQDATA = freqdata
+
+    args = argparse.Namespace(**options)
+    args.device = argparse.FileType('r')(options['device'])
+    backend = BACKENDS[args.backend](args)
+    backend.identity = identity
+
+    while True:
+        if args.frequency and not FREQDATA:
+            FREQDATA = getFreqdata()
+
+        stats = backend.poll()
+
+        try:
+            conn.send({'stats': stats, 'identity': backend.identity, 'freqdata': FREQDATA})
+        except (EOFError, OSError) as e:
+            log.info(f'parent process went away: {e}')
+            backend.close()
+            return
+
+        time.sleep(args.interval)
+
+
+class CollectorWorker(object):
+    """
+    Runs the backend polls in a child process that sends the stats to the HTTP
+    serving parent over a pipe, so a blocking or hung modem only stalls the
+    child. The child is killed and restarted when it exits or sends nothing for
+    WORKER_TIMEOUT seconds longer than the poll interval.
+
+    Children come from a forkserver started before the HTTP server, so they do
+    not inherit the listening socket, the read end of the pipe or the threads
+    of the parent, and a send fails once the parent is gone.
+    """
+
+    def __init__(self, backend, args, registry):
+        self.context = multiprocessing.get_context('forkserver')
+        self.backend = backend
+        self.args = args
+        self.timeout = args.interval + WORKER_TIMEOUT
+        self.process = None
+        self.conn = None
+        self.started = 0
+        self.restarts = Counter('lte_modem_collector_restarts', 'restarts of the collector process',
+                                labelnames=['port'], registry=registry)
+
+    def start(self):
+        options = dict(vars(self.args))
+        options['device'] = self.args.device.name
+
+        self.conn, child_conn = self.context.Pipe(duplex=False)
+        self.process = self.context.Process(target=collectorMain,
+                                            args=(options, self.backend.identity, FREQDATA, log.level, child_conn),
+                                            name='quectel_collector', daemon=True)
+        self.process.start()
+        self.started = time.monotonic()
+        child_conn.close()
+        log.info(f'started collector process {self.process.pid}')
+
+    def stop(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.join(5)
+        if self.process.is_alive():
+            log.critical(f'collector process {self.process.pid} did not terminate, killing it')
+            self.process.kill()
+            self.process.join(5)
+
+    def restart(self):
+        self.stop()
+        self.restarts.labels(self.args.device.name).inc()
+
+        # do not spin on a child that dies right away
+        if time.monotonic() - self.started < self.args.interval:
+            time.sleep(self.args.interval)
+        self.start()
+
+    def receive(self):
+        """ return the next message of the collector process, or None after it had to be restarted """
+        if self.conn.poll(self.timeout):
+            try:
+                return (self.conn.recv())
+            except (EOFError, OSError):
+                self.process.join(1)
+                log.critical(f'collector process {self.process.pid} exited with {self.process.exitcode}, restarting')
+        else:
+            log.critical(f'collector process {self.process.pid} sent nothing for {self.timeout} seconds, restarting')
+
+        self.restart()
+        return (None)
+
+
+def parseData(data):
+    """ run the transform functions of COMMANDS over the raw modem responses and return the stats dict """
+    stats = {}
+    
+    for cmd in COMMANDS.keys():
+        if 'run' in COMMANDS[cmd]:
+            log.debug(f'{cmd} has transform function')
+            COMMANDS[cmd]['run'](data[cmd], stats, cmd)
+    
+    for i in stats['pdp'].keys():
+        stats['pdp'][i]['active'] = stats['pdp_active'][i]['active']
+
+    return(stats)
+
+
+class ModemMetrics(object):
+    """
+    The prometheus metrics of the exporter, update() only sets the metrics that
+    changed since the previous snapshot.
+    """
+
+    def __init__(self, registry):
+        self.info = Info('lte_modem', 'LTE modem and connection info', labelnames=['port'], registry=registry)
+        self.pdp_info = Info('lte_modem_pdp', 'LTE modem pdp info', labelnames=['cid', 'port'], registry=registry)
+
+        self.gauges = {}
+        for i in NUM_DATA:
+            self.gauges[i] = Gauge('lte_modem_' + i, i, labelnames=['port'], registry=registry)
+
+        self.stale = Gauge('lte_modem_stale', 'metrics are restored from the state file and not yet polled from the modem',
+                           labelnames=['port'], registry=registry)
+
+    def update(self, port, stats, previous, stale=False):
+        snapshot = ModemSnapshot(stats)
+        changes, pdp_changes = snapshot.diff(previous)
+        log.debug(f'{len(changes)} fields and {len(pdp_changes)} pdp contexts changed')
+
+        if any(i in changes for i in INFO_DATA):
+            info = {}
+            for i in INFO_DATA:
+                if i in stats:
+                    info[i] = str(stats[i])
+            self.info.labels(port).info(info)
+
+        for i in NUM_DATA:
+            if i in changes and i in stats:
+                self.gauges[i].labels(port).set(stats[i])
+            elif i in changes:
+                # e.g. no paired uplink frequency on the new carrier
+                try:
+                    self.gauges[i].remove(port)
+                except KeyError:
+                    pass
+
+        for i, (old, new) in pdp_changes.items():
+            if new is None:
+                self.pdp_info.remove(i, port)
+            else:
+                self.pdp_info.labels(i, port).info(stats['pdp'][i])
+
+        self.stale.labels(port).set(1 if stale else 0)
+
+        return (snapshot, changes, pdp_changes)
+
+
+def applyCounterOffsets(stats, counters):
+    """
+    Keep the packet counters monotonic over modem resets: when a counter goes
+    backwards its last value is added to the offset of that counter.
+    """
+    for i in ('bytes_sent', 'bytes_recv'):
+        if not isinstance(stats.get(i), int):
             continue
-        lines.append(line)
-        
-    return(lines)
+        counter = counters.setdefault(i, {'last': 0, 'offset': 0})
+        if stats[i] < counter['last']:
+            log.info(f"{i} went from {counter['last']} to {stats[i]}, offset {counter['offset']} -> {counter['offset'] + counter['last']}")
+            counter['offset'] = counter['offset'] + counter['last']
+        counter['last'] = stats[i]
+        stats[i] = stats[i] + counter['offset']
+
+
+def loadState(filename, port):
+    """ return the state saved by saveState() for port, or {} """
+    try:
+        with open(filename) as fp:
+            st = os.fstat(fp.fileno())
+            if st.st_uid != os.getuid() or st.st_mode & 0o022:
+                log.warning(f'ignore state in {filename}, it is not owned by uid {os.getuid()} or writable by others')
+                return ({})
+            state = json.load(fp)
+    except FileNotFoundError:
+        return ({})
+    except Exception as e:
+        log.warning(f'Could not load state from {filename}: {e}')
+        return ({})
+
+    if state.get('version') != STATE_VERSION or state.get('port') != port or 'stats' not in state:
+        log.info(f'ignore state in {filename}, it is not for {port}')
+        return ({})
+
+    return (state)
+
+
+def prepareStateDirectory(filename, uid_name='nobody', gid_name='nogroup'):
+    """ create the directory of the state file, private to the user the exporter drops privileges to """
+    directory = path.dirname(path.abspath(filename))
+    if path.isdir(directory):
+        return
+
+    try:
+        os.makedirs(directory, mode=0o700)
+        if os.getuid() == 0 and uid_name and gid_name:
+            os.chown(directory, pwd.getpwnam(uid_name).pw_uid, grp.getgrnam(gid_name).gr_gid)
+    except Exception as e:
+        log.warning(f'Could not create state directory {directory}: {e}')
 
 
-def getData(args):
+def saveState(filename, state):
+    """ atomically replace filename with the json of state """
+    state['version'] = STATE_VERSION
+    directory = path.dirname(path.abspath(filename))
+    tmpname = None
+    try:
+        with tempfile.NamedTemporaryFile('w', dir=directory, prefix='.' + path.basename(filename), delete=False) as fp:
+            tmpname = fp.name
+            json.dump(state, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpname, filename)
+    except Exception as e:
+        log.warning(f'Could not save state to {filename}: {e}')
+        if tmpname and path.exists(tmpname):
+            os.unlink(tmpname)
+
+
+class ModemReader(object):
+    """
+    Buffered reader for AT command responses.
+
+    All bytes waiting on the serial port are pulled in with a single read() into
+    a reusable bytearray which is scanned for line endings through a memoryview,
+    so a response costs one read per chunk instead of one readline() per line.
+    """
+
+    FINAL_RESULT = (b'OK', b'ERROR')
+    FINAL_ERROR = (b'+CME ERROR', b'+CMS ERROR')
+    WHITESPACE = b' \t\r'
+
+    def __init__(self, modem, name):
+        self.modem = modem
+        self.name = name
+        self.buffer = bytearray()
+
+    def reset(self):
+        self.modem.reset_input_buffer()
+        del self.buffer[:]
+
+    def fill(self):
+        chunk = self.modem.read(max(1, self.modem.in_waiting))
+        if not chunk:
+            raise IOError(f'timeout waiting for a final result code from {self.name}')
+        self.buffer += chunk
+
+    def readResponse(self):
+        """ return the lines of one response up to and including a final ERROR, without the final OK """
+        lines = []
+        debug = log.isEnabledFor(logging.DEBUG)
+        while True:
+            start = 0
+            done = False
+            with memoryview(self.buffer) as view:
+                while not done:
+                    end = self.buffer.find(b'\n', start)
+                    if end < 0:
+                        break
+
+                    first = start
+                    last = end
+                    start = end + 1
+                    while first < last and view[first] in self.WHITESPACE:
+                        first = first + 1
+                    while last > first and view[last - 1] in self.WHITESPACE:
+                        last = last - 1
+                    if first == last:
+                        continue
+
+                    line = view[first:last]
+                    if debug:
+                        log.debug(f'read "{bytes(line)}" from {self.name}')
+                    if line == b'OK':
+                        line.release()
+                        done = True
+                        continue
+
+                    lines.append(str(line, 'utf-8'))
+                    if line in self.FINAL_RESULT or line[:10] in self.FINAL_ERROR:
+                        done = True
+                    line.release()
+
+            del self.buffer[:start]
+            if done:
+                return(lines)
+            self.fill()
+
+
+def getData(args, identity=None):
 
     if args.json:
         fp = open(args.device.name)
@@ -709,20 +1514,34 @@ def getData(args):
                 timeout=2
             )
             log.debug(f'flush serial port {args.device.name}')
-            modem.flushInput()
+            reader = ModemReader(modem, args.device.name)
+            reader.reset()
         
             data = {}
+            if identity and 'imei' in identity:
+                log.debug(f"send {COMMANDS['imei']['cmd']} to {args.device.name}")
+                cmd = COMMANDS['imei']['cmd'] + "\r\n"
+                modem.write(cmd.encode())
+                data['imei'] = reader.readResponse()
+                if data['imei'] == identity['imei']:
+                    log.debug('imei matches the cached identity, skip the static identity commands')
+                    for command in identity.keys():
+                        data[command] = identity[command]
+
             for command in COMMANDS.keys():
+                if command in data:
+                    continue
+
                 if "precmd" in COMMANDS[command]:
                     log.debug(f"send prep command {COMMANDS[command]['precmd']} to {args.device.name}")
                     cmd = COMMANDS[command]['precmd'] + "\r\n"
                     modem.write(cmd.encode())
-                    lines = readLine(modem, args)
+                    lines = reader.readResponse()
                     
                 log.debug(f"send {COMMANDS[command]['cmd']} to {args.device.name}")    
                 cmd = COMMANDS[command]['cmd'] + "\r\n"
                 modem.write(cmd.encode())
-                lines = readLine(modem, args)
+                lines = reader.readResponse()
             
                 data[command] = lines
             
@@ -733,6 +1552,366 @@ def getData(args):
             log.critical(f'Could not open modem port on {args.device.name}: {e}')
             return ({})
 
+class ATBackend(object):
+    """ poll the modem with AT commands over the serial port, or replay a json file of AT responses with -j """
+
+    def __init__(self, args):
+        self.args = args
+        self.identity = {}
+
+    def poll(self):
+        data = getData(self.args, self.identity)
+        if not data:
+            return ({})
+
+        if (self.args.debug):
+            log.debug(json.dumps(data, indent=4))
+
+        self.identity = dict((c, data[c]) for c in COMMANDS if c in data and (COMMANDS[c].get('static') or c == 'imei'))
+        return (parseData(data))
+
+    def close(self):
+        pass
+
+
+QMI_CTL = 0x00
+QMI_WDS = 0x01
+QMI_DMS = 0x02
+QMI_NAS = 0x03
+
+QMI_RADIO_INTERFACE = {0x04: ('GSM', 'GSM'),
+                       0x05: ('WCDMA', 'UTRAN'),
+                       0x08: ('LTE', 'E-UTRAN'),
+                       }
+
+
+def qmiFrame(service, client, flags, transaction, message, tlvs, from_service=False):
+    """ return a QMUX frame of a QMI message, tlvs is a {type: bytes} dict """
+    body = b''.join(struct.pack('<BH', t, len(v)) + v for t, v in tlvs.items())
+    if service == QMI_CTL:
+        sdu = struct.pack('<BBHH', flags, transaction, message, len(body)) + body
+    else:
+        sdu = struct.pack('<BHHH', flags, transaction, message, len(body)) + body
+    return struct.pack('<BHBBB', 0x01, 5 + len(sdu), 0x80 if from_service else 0x00, service, client) + sdu
+
+
+def qmiParse(frame):
+    """ return (service, client, flags, transaction, message, tlvs) of a QMUX frame """
+    if len(frame) < 12 or frame[0] != 0x01:
+        raise IOError(f'not a QMUX frame: {bytes(frame[:16]).hex()}')
+
+    service, client = struct.unpack_from('<BB', frame, 4)
+    if service == QMI_CTL:
+        flags, transaction, message, size = struct.unpack_from('<BBHH', frame, 6)
+        offset = 12
+    else:
+        flags, transaction, message, size = struct.unpack_from('<BHHH', frame, 6)
+        offset = 13
+
+    tlvs = {}
+    end = min(offset + size, len(frame))
+    while offset + 3 <= end:
+        t, length = struct.unpack_from('<BH', frame, offset)
+        offset = offset + 3
+        tlvs[t] = bytes(frame[offset:offset + length])
+        offset = offset + length
+
+    return (service, client, flags, transaction, message, tlvs)
+
+
+class QmiError(IOError):
+    """ a QMI response with a failed result TLV, the device itself is fine """
+    pass
+
+
+class QmiDevice(object):
+    """ QMI request/response transactions over the file descriptor of a /dev/cdc-wdm device """
+
+    def __init__(self, fd, name, timeout=2, sock=None):
+        self.fd = fd
+        self.name = name
+        self.timeout = timeout
+        self.sock = sock
+        self.transaction = 0
+
+    def close(self):
+        """ close the device, through the socket object when the fd belongs to one """
+        if self.sock is not None:
+            self.sock.close()
+        else:
+            os.close(self.fd)
+
+    def request(self, service, client, message, tlvs=None):
+        """ send a request and return the tlvs of the response, raises IOError on a timeout and QmiError on a QMI error """
+        self.transaction = self.transaction % (0xff if service == QMI_CTL else 0xffff) + 1
+        os.write(self.fd, qmiFrame(service, client, 0x00, self.transaction, message, tlvs or {}))
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                raise IOError(f'timeout waiting for QMI message 0x{message:04x} of service {service} from {self.name}')
+
+            r_service, r_client, r_flags, r_transaction, r_message, r_tlvs = qmiParse(os.read(self.fd, 4096))
+            if (r_service, r_client, r_transaction, r_message) != (service, client, self.transaction, message):
+                log.debug(f'skip QMI message 0x{r_message:04x} of service {r_service} from {self.name}')
+                continue
+
+            if 0x02 in r_tlvs:
+                result, error = struct.unpack_from('<HH', r_tlvs[0x02])
+                if result != 0:
+                    raise QmiError(f'QMI message 0x{message:04x} of service {service} failed with error {error}')
+            return (r_tlvs)
+
+    def allocate(self, service):
+        return (self.request(QMI_CTL, 0, 0x0022, {0x01: bytes([service])})[0x01][1])
+
+    def release(self, service, client):
+        self.request(QMI_CTL, 0, 0x0023, {0x01: bytes([service, client])})
+
+
+class QmiBackend(object):
+    """
+    Poll the modem with binary QMI messages over /dev/cdc-wdm*, the device stays
+    open and the client ids allocated between polls. Fills the same stats keys
+    as the AT transform functions, except for the UE state (QENG state/state_txt),
+    the pdp contexts and the SIM, network name and CIND fields.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.identity = {}
+        self.device = None
+        self.clients = {}
+
+    def open(self):
+        fd = os.open(self.args.device.name, os.O_RDWR | os.O_NOCTTY)
+        return (QmiDevice(fd, self.args.device.name))
+
+    def close(self):
+        if self.device is None:
+            return
+        for service, client in self.clients.items():
+            try:
+                self.device.release(service, client)
+            except Exception as e:
+                log.debug(f'could not release QMI client {client} of service {service}: {e}')
+        self.device.close()
+        self.device = None
+        self.clients = {}
+
+    def request(self, service, message, tlvs=None):
+        return (self.device.request(service, self.clients[service], message, tlvs))
+
+    def poll(self):
+        try:
+            if self.device is None:
+                log.debug(f'open QMI device {self.args.device.name}')
+                self.device = self.open()
+                for service in (QMI_DMS, QMI_NAS, QMI_WDS):
+                    self.clients[service] = self.device.allocate(service)
+
+            stats = {}
+            for poll in (self.pollIdentity, self.pollServingSystem, self.pollSignalInfo,
+                         self.pollRfBandInfo, self.pollPacketStatistics):
+                # a failed message only leaves out its own fields, e.g. WDS statistics without a data session
+                try:
+                    poll(stats)
+                except QmiError as e:
+                    log.info(f'{poll.__name__} on {self.args.device.name}: {e}')
+            return (stats)
+        except Exception as e:
+            log.critical(f'Could not poll QMI device {self.args.device.name}: {e}')
+            self.close()
+            return ({})
+
+    def pollIdentity(self, stats):
+        """ DMS Get IDs, and Get Manufacturer/Model/Revision unless the IMEI matches the cached identity """
+        tlvs = self.request(QMI_DMS, 0x0025)
+        if 0x11 in tlvs:
+            stats['imei'] = tlvs[0x11].decode()
+
+        if 'imei' in stats and self.identity.get('imei') == stats['imei']:
+            stats.update(self.identity)
+            return
+
+        for message, i in ((0x0021, 'manufacturer'), (0x0022, 'model'), (0x0023, 'firmware')):
+            stats[i] = self.request(QMI_DMS, message)[0x01].decode()
+        self.identity = dict((i, stats[i]) for i in ('imei', 'manufacturer', 'model', 'firmware') if i in stats)
+
+    def pollServingSystem(self, stats):
+        """ NAS Get Serving System """
+        tlvs = self.request(QMI_NAS, 0x0024)
+        registration, cs_attach, ps_attach, network, count = struct.unpack_from('<BBBBB', tlvs[0x01])
+        radio = tlvs[0x01][5] if count else 0
+        roaming = 0x10 in tlvs and tlvs[0x10][0] == 0
+
+        # registration states 0-4 are the NEWORK_STATUS keys, the UE state (QENG) has no QMI equivalent here
+        status = str(registration) if str(registration) in NEWORK_STATUS else '4'
+        if status == '1' and roaming:
+            status = '5'
+        stats['connection_status'] = NEWORK_STATUS[status]
+
+        if radio in QMI_RADIO_INTERFACE:
+            stats['connection_type'], stats['access_technology'] = QMI_RADIO_INTERFACE[radio]
+
+        if 0x12 in tlvs:
+            mcc, mnc, length = struct.unpack_from('<HHB', tlvs[0x12])
+            stats['mcc'] = mcc
+            stats['mnc'] = mnc
+            stats['operator_num'] = int(f'{mcc}{mnc:02d}')
+            stats['operator'] = tlvs[0x12][5:5 + length].decode(errors='replace')
+        if 0x1C in tlvs:
+            stats['lac'] = struct.unpack_from('<H', tlvs[0x1C])[0]
+        if 0x1D in tlvs:
+            stats['cellID'] = struct.unpack_from('<I', tlvs[0x1D])[0]
+        # LTE TAC (guint16) sits between HDR Personality (0x24) and Call Barring Status (0x26, two guint32),
+        # only take an exact 2 byte value so a misplaced TLV is never exported as the tac
+        if 0x25 in tlvs and len(tlvs[0x25]) == 2:
+            stats['tac'] = struct.unpack_from('<H', tlvs[0x25])[0]
+
+    def pollSignalInfo(self, stats):
+        """ NAS Get Signal Info, LTE TLV """
+        tlvs = self.request(QMI_NAS, 0x004F)
+        if 0x14 in tlvs:
+            rssi, rsrq, rsrp, snr = struct.unpack_from('<bbhh', tlvs[0x14])
+            stats['rssi'] = rssi
+            stats['rsrq'] = rsrq
+            stats['rsrp'] = rsrp
+            # QMI reports the SNR in 0.1 dB, QENG in 0.2 dB steps from -20 dB
+            stats['sinr'] = round((snr / 10 + 20) * 5)
+
+    def pollRfBandInfo(self, stats):
+        """ NAS Get RF Band Info, the band is looked up from the EARFCN """
+        tlvs = self.request(QMI_NAS, 0x0031)
+
+        # the extended TLV has a 32 bit channel, the legacy one cannot hold EARFCNs above 65535 (bands 65-71)
+        if 0x11 in tlvs:
+            value, layout, size = tlvs[0x11], '<BHI', 7
+        else:
+            value, layout, size = tlvs[0x01], '<BHH', 5
+
+        count = value[0]
+        i = 0
+        while i < count:
+            radio, band_class, channel = struct.unpack_from(layout, value, 1 + i * size)
+            i = i + 1
+            if radio != 0x08:
+                continue
+
+            stats['earfcn'] = channel
+            stats['channel'] = channel
+            setCarrierFrequency(channel, stats)
+            carrier = carrierFrequency(channel)
+            if carrier is None:
+                continue
+
+            band = carrier[0]
+            stats['freq_band_ind'] = band
+            stats['band'] = f'LTE BAND {band}'
+            stats['is_tdd'] = 'TDD' if 33 <= band <= 48 else 'FDD'
+            if FREQDATA and str(band) in FREQDATA:
+                for header in FREQDATA[str(band)].keys():
+                    stats["freq_" + header] = FREQDATA[str(band)][header]
+
+    def pollPacketStatistics(self, stats):
+        """ WDS Get Packet Statistics, tx/rx bytes ok """
+        tlvs = self.request(QMI_WDS, 0x0024, {0x01: struct.pack('<I', 0x40 | 0x80)})
+        if 0x19 in tlvs:
+            stats['bytes_sent'] = struct.unpack_from('<Q', tlvs[0x19])[0]
+        if 0x1A in tlvs:
+            stats['bytes_recv'] = struct.unpack_from('<Q', tlvs[0x1A])[0]
+
+
+class QmiSimulator(threading.Thread):
+    """
+    Simulated QMI endpoint serving the QmiBackend messages on one end of a
+    SOCK_SEQPACKET socketpair, which like /dev/cdc-wdm keeps message boundaries.
+    The values match modem-input.json, except that every other poll the modem
+    is on a band 66 carrier with an EARFCN above 65535.
+    """
+
+    def __init__(self, sock):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = sock
+        self.clients = 0
+        self.counter = 0
+        self.responses = {
+            (QMI_DMS, 0x0021): {0x01: b'Quectel'},
+            (QMI_DMS, 0x0022): {0x01: b'EG25'},
+            (QMI_DMS, 0x0023): {0x01: b'EG25GGBR07A08M2G'},
+            (QMI_DMS, 0x0025): {0x11: b'867698045355909'},
+            (QMI_NAS, 0x0024): {0x01: bytes([1, 1, 1, 2, 1, 0x08]),
+                                0x10: bytes([1]),
+                                0x12: struct.pack('<HHB', 222, 88, 7) + b'WINDTRE',
+                                0x1C: struct.pack('<H', 8119),
+                                0x1D: struct.pack('<I', 0x586A500),
+                                0x25: struct.pack('<H', 8119),
+                                0x26: struct.pack('<II', 0, 0)},
+            (QMI_NAS, 0x004F): {0x14: struct.pack('<bbhh', -75, -15, -112, -186)},
+        }
+
+    def respond(self, service, message, tlvs):
+        if service == QMI_CTL and message == 0x0022:
+            self.clients = self.clients + 1
+            return ({0x01: bytes([tlvs[0x01][0], self.clients])})
+        if service == QMI_CTL and message == 0x0023:
+            return ({0x01: tlvs[0x01]})
+        if service == QMI_NAS and message == 0x0031:
+            if self.counter % 2 == 0:
+                return ({0x01: struct.pack('<BBHH', 1, 0x08, 122, 1650)})
+            # band 66: only the extended TLV holds the EARFCN, the legacy channel is truncated to 16 bits
+            return ({0x01: struct.pack('<BBHH', 1, 0x08, 0, 66500 & 0xffff),
+                     0x11: struct.pack('<BBHI', 1, 0x08, 0, 66500)})
+        if service == QMI_WDS and message == 0x0024:
+            self.counter = self.counter + 1
+            return ({0x19: struct.pack('<Q', 18346457 + self.counter * 1000),
+                     0x1A: struct.pack('<Q', 353683715 + self.counter * 10000)})
+        return (self.responses.get((service, message)))
+
+    def run(self):
+        while True:
+            try:
+                frame = self.sock.recv(4096)
+            except OSError:
+                return
+            if not frame:
+                return
+
+            service, client, flags, transaction, message, tlvs = qmiParse(frame)
+            response = self.respond(service, message, tlvs)
+            if response is None:
+                # QMI_ERR_INVALID_QMI_CMD
+                response = {0x02: struct.pack('<HH', 1, 0x47)}
+            else:
+                response[0x02] = struct.pack('<HH', 0, 0)
+
+            self.sock.send(qmiFrame(service, client, 0x01 if service == QMI_CTL else 0x02,
+                                    transaction, message, response, from_service=True))
+
+
+class QmiSimBackend(QmiBackend):
+    """ QmiBackend talking to a QmiSimulator instead of a device """
+
+    def open(self):
+        host, modem = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.simulator = QmiSimulator(modem)
+        self.simulator.start()
+        return (QmiDevice(host.fileno(), 'qmi simulator', sock=host))
+
+    def close(self):
+        if self.device is None:
+            return
+        QmiBackend.close(self)
+        self.simulator.sock.close()
+
+
+BACKENDS = {'at': ATBackend,
+            'qmi': QmiBackend,
+            'qmi-sim': QmiSimBackend,
+            }
+
+
 def getFreqdata():
     import urllib.request
     log.info(f'fetch data from {FREQ_URL}')